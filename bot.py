@@ -2,11 +2,20 @@
 
 """TLDR Discord Bot - Summarizes channel messages using Gemini AI."""
 
+import asyncio
+import hashlib
+import io
+import json
 import logging
-import re
+import time
+import zlib
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
-from typing import Optional
+from functools import lru_cache
+from pathlib import Path
+from typing import AsyncIterator, Optional
 
+from cachetools import TTLCache
 import discord
 from discord import Embed
 from discord import app_commands
@@ -21,12 +30,47 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+UTC = timezone.utc
+
 # Discord embed limits
 EMBED_DESC_LIMIT = 4096
 MAX_EMBEDS_PER_MESSAGE = 10
 
-# Time parsing pattern (e.g., "1h", "30m", "2d")
-TIME_PATTERN = re.compile(r"^(\d+)([mhd])$", re.IGNORECASE)
+# Finish reasons for which a streamed summary is complete
+COMPLETE_FINISH_REASONS = (
+    genai.protos.Candidate.FinishReason.STOP,
+    genai.protos.Candidate.FinishReason.MAX_TOKENS,
+)
+
+# Seconds per time unit suffix (e.g., "1h", "30m", "2d")
+TIME_UNITS: dict[str, int] = {"m": 60, "h": 3600, "d": 86400}
+
+# Summary prompt split around the messages; the head has no placeholders and
+# is formatted once here to unescape any braces, while the tail depends only
+# on the focus, so it is formatted once per focus string
+PROMPT_HEAD, PROMPT_TAIL = config.SUMMARY_PROMPT.split("{messages}")
+PROMPT_HEAD = PROMPT_HEAD.format()
+
+# Recently generated summaries, keyed by request fingerprint
+summary_cache: TTLCache[str, str] = TTLCache(
+    maxsize=config.SUMMARY_CACHE_SIZE,
+    ttl=config.SUMMARY_CACHE_TTL_SECONDS,
+)
+
+# Once a slab is half full, it ends after any message whose id hashes to a
+# multiple of this, so slab boundaries depend on the messages themselves
+SLAB_BOUNDARY_ODDS = 64
+
+# Partial summaries of message slabs, reused when the same messages come back
+slab_summary_cache: TTLCache[str, str] = TTLCache(
+    maxsize=config.SUMMARY_CACHE_SIZE,
+    ttl=config.SUMMARY_CACHE_TTL_SECONDS,
+)
+
+# Locks for in-flight requests, keyed like summary_cache, so concurrent
+# identical requests only hit Gemini once; each entry counts its users so it
+# can be dropped when the last one is done
+request_locks: dict[str, tuple[asyncio.Lock, int]] = {}
 
 
 class TimeParseError(Exception):
@@ -48,58 +92,175 @@ def parse_time_ago(time_str: str) -> timedelta:
     Raises:
         TimeParseError: If the format is invalid
     """
-    match = TIME_PATTERN.match(time_str.strip())
-    if not match:
+    normalized = time_str.strip().lower()
+    value = normalized[:-1]
+    seconds_per_unit = TIME_UNITS.get(normalized[-1:])
+
+    if seconds_per_unit is None or not value.isdecimal():
         raise TimeParseError(
             f"Invalid time format: `{time_str}`. Use format like `30m`, `1h`, or `2d`."
         )
 
-    value = int(match.group(1))
-    unit = match.group(2).lower()
+    return timedelta(seconds=int(value) * seconds_per_unit)
 
-    if value < 0:
-        raise TimeParseError("Time value must be greater than 0.")
 
-    if unit == "m":
-        return timedelta(minutes=value)
-    elif unit == "h":
-        return timedelta(hours=value)
-    elif unit == "d":
-        return timedelta(days=value)
-    else:
-        raise TimeParseError(f"Unknown time unit: {unit}")
+def utf16_length(text: str) -> int:
+    """Return the length of text as Discord counts it, in UTF-16 code units."""
+    return len(text.encode("utf-16-le")) // 2
 
 
-def split_text_into_chunks(text: str, max_length: int = EMBED_DESC_LIMIT) -> list[str]:
+def split_text_into_chunks(
+    text: str,
+    max_length: int = EMBED_DESC_LIMIT,
+    max_chunks: Optional[int] = None,
+) -> list[str]:
     """
     Split text into chunks that fit within Discord's embed description limit.
     Tries to split at newlines to keep bullet points intact.
+    Stops after max_chunks chunks, if given, leaving the rest of the text unsplit.
     """
-    if len(text) <= max_length:
+    # Discord measures length in UTF-16 code units, so characters outside
+    # the Basic Multilingual Plane (most emoji) count twice
+    text_units = utf16_length(text)
+    if text_units <= max_length:
         return [text]
+    has_wide_chars = text_units != len(text)
 
     chunks: list[str] = []
-    remaining = text
+    start = 0
+    length = len(text)
 
-    while remaining:
-        if len(remaining) <= max_length:
-            chunks.append(remaining)
+    while start < length:
+        if len(chunks) == max_chunks:
             break
 
         # Find a good split point (prefer newlines)
-        split_point = max_length
+        split_point = min(start + max_length, length)
+        if has_wide_chars:
+            # Drop characters until the chunk fits; each is worth one or two
+            # code units, so dropping half the excess overshoots by at most one
+            excess = utf16_length(text[start:split_point]) - max_length
+            while excess > 0:
+                split_point -= (excess + 1) // 2
+                excess = utf16_length(text[start:split_point]) - max_length
+
+        if split_point >= length:
+            chunks.append(text[start:])
+            break
 
         # Look for the last newline within the limit
-        last_newline = remaining.rfind("\n", 0, max_length)
-        if last_newline > max_length // 2:  # Only use if it's not too early
+        last_newline = text.rfind("\n", start, split_point)
+        if last_newline - start > max_length // 2:  # Only use if it's not too early
             split_point = last_newline + 1  # Include the newline in current chunk
 
-        chunks.append(remaining[:split_point].rstrip())
-        remaining = remaining[split_point:].lstrip()
+        chunks.append(text[start:split_point].rstrip())
+
+        # Skip leading whitespace of the next chunk
+        start = split_point
+        while start < length and text[start].isspace():
+            start += 1
 
     return chunks
 
 
+def format_messages(messages: list[discord.Message]) -> str:
+    """
+    Format messages for the LLM prompt, one "Username: content" line per message.
+    Line breaks inside a message are replaced with a visible marker.
+    """
+    buffer = io.StringIO()
+    write = buffer.write
+    for message in messages:
+        write(message.author.display_name.replace("\n", " "))
+        write(": ")
+        write(message.content.replace("\n", " ⏎ "))
+        write("\n")
+    return buffer.getvalue()
+
+
+@lru_cache(maxsize=64)
+def format_prompt_tail(focus: str) -> str:
+    """Fill in the focus instructions that follow the messages in the prompt."""
+    return PROMPT_TAIL.format(focus=focus)
+
+
+def split_into_slabs(
+    messages: list[discord.Message], max_length: int
+) -> list[list[discord.Message]]:
+    """
+    Split messages into consecutive slabs whose formatted length fits max_length.
+
+    Past half of max_length, a slab ends after any message whose id hashes to a
+    boundary. Boundaries therefore follow the messages rather than where the
+    time window starts, and overlapping windows share most of their slabs.
+    """
+    slabs: list[list[discord.Message]] = []
+    slab: list[discord.Message] = []
+    slab_length = 0
+
+    for message in messages:
+        # Same length as the line format_messages() writes for this message
+        content = message.content
+        length = len(message.author.display_name) + len(content) + 2 * content.count("\n") + 3
+
+        if slab and slab_length + length > max_length:
+            slabs.append(slab)
+            slab = []
+            slab_length = 0
+
+        slab.append(message)
+        slab_length += length
+
+        if (
+            slab_length >= max_length // 2
+            and zlib.crc32(message.id.to_bytes(8, "little")) % SLAB_BOUNDARY_ODDS == 0
+        ):
+            slabs.append(slab)
+            slab = []
+            slab_length = 0
+
+    if slab:
+        slabs.append(slab)
+
+    return slabs
+
+
+@asynccontextmanager
+async def request_lock(cache_key: str) -> AsyncIterator[None]:
+    """
+    Hold the lock for a summary request while it is being generated.
+
+    Requests with different keys run concurrently; identical ones wait for the
+    first to finish so they can reuse its cached summary.
+    """
+    lock, users = request_locks.get(cache_key, (asyncio.Lock(), 0))
+    request_locks[cache_key] = (lock, users + 1)
+    try:
+        async with lock:
+            yield
+    finally:
+        lock, users = request_locks[cache_key]
+        if users == 1:
+            del request_locks[cache_key]
+        else:
+            request_locks[cache_key] = (lock, users - 1)
+
+
+def summary_cache_key(
+    channel_id: int, focus: str, messages: list[discord.Message]
+) -> str:
+    """
+    Build a cache key identifying a summary request.
+
+    Two requests share a key when they target the same channel with the same
+    focus and cover exactly the same set of messages.
+    """
+    digest = hashlib.sha1(f"{channel_id}\0{focus}\0".encode("utf-8"))
+    for message in messages:
+        digest.update(message.id.to_bytes(8, "little"))
+    return digest.hexdigest()
+
+
 class TLDRBot(discord.Client):
     """Discord bot that provides TLDR summaries of channel messages."""
 
@@ -119,14 +280,53 @@ class TLDRBot(discord.Client):
         self.gemini_model = genai.GenerativeModel(config.GEMINI_MODEL)
 
     async def setup_hook(self) -> None:
-        """Called when the bot is starting up. Syncs slash commands."""
-        await self.tree.sync()
-        logger.info("Slash commands synced")
+        """Called when the bot is starting up. Syncs slash commands if they changed."""
+        commands_hash = self.commands_hash()
+        # Relative paths are resolved next to this file, not the working directory
+        hash_file = Path(__file__).parent / config.COMMANDS_HASH_FILE
+
+        try:
+            synced_hash = hash_file.read_text().strip()
+        except OSError:
+            synced_hash = None
+
+        if synced_hash == commands_hash:
+            logger.info("Slash commands unchanged, skipping sync")
+        else:
+            await self.tree.sync()
+            logger.info("Slash commands synced")
+            try:
+                hash_file.write_text(commands_hash)
+            except OSError as e:
+                logger.warning("Could not save slash command hash to %s: %s", hash_file, e)
+
+        await self.warm_up_gemini()
+
+    def commands_hash(self) -> str:
+        """Hash the application ID and command tree to detect changes needing a sync."""
+        commands = [command.to_dict(self.tree) for command in self.tree.get_commands()]
+        payload = json.dumps([self.application_id, commands], sort_keys=True)
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    async def warm_up_gemini(self) -> None:
+        """
+        Open the Gemini connection ahead of the first /tldr request.
+
+        The async client and its channel are created lazily and then reused for
+        every later request, so a cheap token count here moves the connection
+        setup out of the first user's request.
+        """
+        try:
+            await self.gemini_model.count_tokens_async("ping")
+        except Exception as e:
+            logger.warning("Gemini warm-up failed: %s", e)
+        else:
+            logger.info("Gemini connection established")
 
     async def on_ready(self) -> None:
         """Called when the bot is fully connected and ready."""
-        logger.info(f"Logged in as {self.user} (ID: {self.user.id})")
-        logger.info(f"Connected to {len(self.guilds)} guild(s)")
+        logger.info("Logged in as %s (ID: %s)", self.user, self.user.id)
+        logger.info("Connected to %d guild(s)", len(self.guilds))
         logger.info("Bot is ready!")
 
 
@@ -134,6 +334,90 @@ class TLDRBot(discord.Client):
 bot = TLDRBot()
 
 
+async def fetch_messages(
+    channel: discord.abc.Messageable, start_time: datetime, end_time: datetime
+) -> list[discord.Message]:
+    """Fetch human-written messages between start_time and end_time, oldest first."""
+    messages: list[discord.Message] = []
+    append = messages.append
+    async for message in channel.history(
+        limit=config.MAX_MESSAGES,
+        after=start_time,
+        before=end_time,
+        oldest_first=True,
+    ):
+        # Only include messages from human users (not bots)
+        if message.author.bot:
+            continue
+        # Skip empty or whitespace-only messages without copying the content
+        content = message.content
+        if content and not content.isspace():
+            append(message)
+
+    return messages
+
+
+async def summarize_slab(channel_id: int, slab: list[discord.Message]) -> str:
+    """Summarize one slab of a conversation too long to summarize at once."""
+    cache_key = summary_cache_key(channel_id, "", slab)
+    summary = slab_summary_cache.get(cache_key)
+
+    if summary is None:
+        formatted_messages = await asyncio.to_thread(format_messages, slab)
+        response = await bot.gemini_model.generate_content_async(
+            config.SLAB_SUMMARY_PROMPT.format(messages=formatted_messages)
+        )
+        summary = response.text
+        slab_summary_cache[cache_key] = summary
+
+    return summary
+
+
+async def build_prompt(
+    channel_id: int, messages: list[discord.Message], focus: str
+) -> str:
+    """
+    Build the summary prompt for the given messages.
+
+    If the prompt would exceed MAX_PROMPT_TOKENS, the messages are split into
+    consecutive slabs that are summarized in parallel, and the prompt asks for
+    a summary of those partial summaries instead.
+    """
+    # Format messages for the LLM off the event loop, since large
+    # time ranges can take long enough to delay other events
+    formatted_messages = await asyncio.to_thread(format_messages, messages)
+    prompt = PROMPT_HEAD + formatted_messages + format_prompt_tail(focus)
+
+    # A token is almost never shorter than a character, so only ask Gemini
+    # for an exact count when the prompt is long enough to be over budget
+    if len(prompt) <= config.MAX_PROMPT_TOKENS:
+        return prompt
+
+    token_count = (await bot.gemini_model.count_tokens_async(prompt)).total_tokens
+    if token_count <= config.MAX_PROMPT_TOKENS:
+        return prompt
+
+    # Bound slabs by characters, which also keeps them within the token budget
+    slabs = split_into_slabs(
+        messages, config.MAX_PROMPT_TOKENS - len(config.SLAB_SUMMARY_PROMPT)
+    )
+
+    logger.info(
+        "Prompt for %d messages is %d tokens; summarizing in %d parts",
+        len(messages),
+        token_count,
+        len(slabs),
+    )
+
+    partial_summaries = await asyncio.gather(
+        *(summarize_slab(channel_id, slab) for slab in slabs)
+    )
+    summaries = "\n\n".join(
+        f"Part {i}:\n{summary}" for i, summary in enumerate(partial_summaries, start=1)
+    )
+    return config.MERGE_PROMPT.format(summaries=summaries, focus=focus)
+
+
 @bot.tree.command(name="tldr", description="Get a summary of messages in this channel within a time range")
 @app_commands.allowed_installs(guilds=True, users=True)
 @app_commands.allowed_contexts(guilds=True, dms=True, private_channels=True)
@@ -185,20 +469,12 @@ async def tldr_command(
             return
 
         # Calculate actual timestamps
-        now = datetime.now(timezone.utc)
+        now = datetime.now(UTC)
         start_time = now - start_delta
         end_time = now - end_delta
 
-        # Fetch messages from the channel within the time range
-        messages: list[discord.Message] = []
-        async for message in interaction.channel.history(
-            limit=config.MAX_MESSAGES,
-            after=start_time,
-            before=end_time,
-        ):
-            # Only include messages from human users (not bots)
-            if not message.author.bot and message.content.strip():
-                messages.append(message)
+        # Fetch messages from the channel within the time range, oldest first
+        messages = await fetch_messages(interaction.channel, start_time, end_time)
 
         if not messages:
             await interaction.followup.send(
@@ -207,69 +483,118 @@ async def tldr_command(
             )
             return
 
-        # Sort in chronological order (oldest first)
-        messages.sort(key=lambda m: m.created_at)
-
-        # Format messages for the LLM
-        formatted_messages = "\n".join(
-            f"{repr(msg.author.display_name)}: {repr(msg.content)}" for msg in messages
-        )
-
         # Determine focus areas (custom or default)
         focus_text = focus if focus else config.DEFAULT_FOCUS
 
-        # Generate summary using Gemini
-        prompt = config.SUMMARY_PROMPT.format(
-            focus=focus_text,
-            messages=formatted_messages,
-        )
-
-        logger.info(
-            f"Generating summary for {len(messages)} messages in "
-            f"#{interaction.channel.name} (requested by {interaction.user})"
-        )
-
-        response = await bot.gemini_model.generate_content_async(prompt)
-
-        # Check if we got a valid response
-        if not response.text:
-            await interaction.followup.send(
-                "❌ Failed to generate summary. The AI returned an empty response. "
-                "Please try again."
-            )
-            return
-
-        summary = response.text
+        cache_key = summary_cache_key(interaction.channel.id, focus_text, messages)
+
+        # Identical concurrent requests wait for the first one and then
+        # reuse its cached summary
+        async with request_lock(cache_key):
+            summary = summary_cache.get(cache_key)
+
+            if summary is None:
+                prompt = await build_prompt(interaction.channel.id, messages, focus_text)
+
+                # Generate summary using Gemini
+                logger.info(
+                    "Generating summary for %d messages in #%s (requested by %s)",
+                    len(messages),
+                    interaction.channel.name,
+                    interaction.user,
+                )
+
+                response = await bot.gemini_model.generate_content_async(prompt, stream=True)
+
+                # Collect the streamed summary, periodically showing progress
+                parts: list[str] = []
+                last_update = time.monotonic()
+                async for part in response:
+                    if not part.parts:
+                        continue
+                    parts.append(part.text)
+
+                    if time.monotonic() - last_update >= config.STREAM_UPDATE_INTERVAL:
+                        preview = "".join(parts)
+                        if utf16_length(preview) > EMBED_DESC_LIMIT:
+                            preview = split_text_into_chunks(
+                                preview, EMBED_DESC_LIMIT - 1, max_chunks=1
+                            )[0] + "…"
+                        await interaction.edit_original_response(
+                            embed=discord.Embed(
+                                title="📋 TL;DR Summary",
+                                description=preview,
+                                color=discord.Color.blue(),
+                            )
+                        )
+                        last_update = time.monotonic()
+
+                summary = "".join(parts)
+
+                # Check that generation finished normally; a stream stopped for
+                # safety or another blocking reason leaves only partial text
+                candidate = response.candidates[0] if response.candidates else None
+                if candidate is None or candidate.finish_reason not in COMPLETE_FINISH_REASONS:
+                    if candidate is None:
+                        reason = response.prompt_feedback.block_reason.name
+                    else:
+                        reason = candidate.finish_reason.name
+                    logger.warning("Summary generation stopped early: %s", reason)
+                    await interaction.edit_original_response(
+                        content=f"❌ Failed to generate summary. The AI stopped early ({reason}). "
+                        "Please try again.",
+                        embeds=[],
+                    )
+                    return
+
+                # Check if we got a valid response
+                if not summary:
+                    await interaction.edit_original_response(
+                        content="❌ Failed to generate summary. The AI returned an empty response. "
+                        "Please try again.",
+                        embeds=[],
+                    )
+                    return
+
+                summary_cache[cache_key] = summary
+            else:
+                logger.info(
+                    "Using cached summary for %d messages in #%s (requested by %s)",
+                    len(messages),
+                    interaction.channel.name,
+                    interaction.user,
+                )
 
         # Build footer text
         footer_text = f"Summarized {len(messages)} messages • {start} → {end}"
         if focus:
-            footer_text += f" • Focus: {focus[:50]}{'...' if len(focus) > 50 else ''}"
+            short_focus = focus if len(focus) <= 50 else focus[:47] + "..."
+            footer_text += f" • Focus: {short_focus}"
 
         # Split summary into chunks if needed
-        chunks = split_text_into_chunks(summary)
+        chunks = split_text_into_chunks(summary, max_chunks=MAX_EMBEDS_PER_MESSAGE)
 
         # Create embeds for each chunk
         embeds: list[Embed] = []
+        color = discord.Color.blue().value
+        last = min(len(chunks), MAX_EMBEDS_PER_MESSAGE) - 1
         for i, chunk in enumerate(chunks[:MAX_EMBEDS_PER_MESSAGE]):
-            embed = discord.Embed(
-                description=chunk,
-                color=discord.Color.blue(),
-            )
+            data = {"description": chunk, "color": color}
             # Add title only to first embed
             if i == 0:
-                embed.title = "📋 TL;DR Summary"
+                data["title"] = "📋 TL;DR Summary"
             # Add footer only to last embed
-            if i == len(chunks) - 1 or i == MAX_EMBEDS_PER_MESSAGE - 1:
-                embed.set_footer(text=footer_text)
-            embeds.append(embed)
+            if i == last:
+                data["footer"] = {"text": footer_text}
+            embeds.append(Embed.from_dict(data))
 
-        # Send all embeds
-        await interaction.followup.send(embeds=embeds)
+        # Send all embeds, replacing any in-progress preview
+        await interaction.edit_original_response(embeds=embeds)
 
         logger.info(
-            f"Summary sent successfully for #{interaction.channel.name} "
-            f"({len(embeds)} embed(s))"
+            "Summary sent successfully for #%s (%d embed(s))",
+            interaction.channel.name,
+            len(embeds),
         )
 
     except discord.Forbidden:
@@ -286,9 +611,11 @@ async def tldr_command(
                 "Make sure I have the **Read Message History** permission."
             )
     except Exception as e:
-        logger.exception(f"Error generating summary: {e}")
-        await interaction.followup.send(
-            f"❌ An error occurred while generating the summary: {str(e)}"
+        logger.exception("Error generating summary: %s", e)
+        # Replace any in-progress summary preview with the error
+        await interaction.edit_original_response(
+            content=f"❌ An error occurred while generating the summary: {str(e)}",
+            embeds=[],
         )
 
 
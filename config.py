@@ -26,10 +26,17 @@ GEMINI_API_KEY: str = get_required_env("GEMINI_API_KEY")
 MAX_MESSAGES: int = 10000  # Maximum messages to fetch within time range
 MAX_TIME_RANGE_DAYS: int = 3  # Maximum time range allowed
 GEMINI_MODEL: str = "gemini-2.5-flash"
+MAX_PROMPT_TOKENS: int = 200000  # Longer conversations are summarized in parts first
+STREAM_UPDATE_INTERVAL: float = 1.5  # Seconds between in-progress summary updates
+COMMANDS_HASH_FILE: str = ".commands_hash"  # Hash of the last synced slash commands (relative to bot.py)
+
+# Summary cache settings
+SUMMARY_CACHE_SIZE: int = 256  # Maximum number of cached summaries
+SUMMARY_CACHE_TTL_SECONDS: int = 600  # How long a cached summary stays valid
 
 # Default focus areas for the summary
 DEFAULT_FOCUS: str = """
-Analyze the following Discord messages and provide a clear, concise summary in bullet points.
+Analyze the Discord messages above and provide a clear, concise summary in bullet points.
 Focus on:
 - Key topics discussed
 - Important decisions or conclusions
@@ -39,15 +46,54 @@ Focus on:
 Format your response as bullet points. Be concise but capture the essential information.
 If the conversation is very short or trivial, still provide a brief summary."""
 
-# Prompt for the LLM (use {focus} and {messages} placeholders)
+# Prompt for the LLM (use {messages} and {focus} placeholders; {focus} must come
+# after {messages}, since the text before the messages is not given the focus)
+# The static preamble and the messages come first so that repeated requests
+# over the same channel share a long prompt prefix for Gemini's implicit
+# context caching; the variable focus instructions go at the end.
 SUMMARY_PROMPT: str = """You are a helpful assistant that summarizes Discord chat conversations.
+Messages are formatted as "Username: Message content", one per line, in chronological order (oldest first).
+Line breaks within a message are shown as "⏎".
+
+---
+MESSAGES:
+{messages}
+---
+
+Focus instructions:
 {focus}
-Messages are formatted as "'Username': 'Message content'" and are in chronological order (oldest first).
+
+Provide your bullet-point summary:"""
+
+# Prompt for summarizing one part of a conversation too long to summarize at once
+# (use the {messages} placeholder)
+SLAB_SUMMARY_PROMPT: str = """You are a helpful assistant that summarizes part of a longer Discord chat conversation.
+Messages are formatted as "Username: Message content", one per line, in chronological order (oldest first).
+Line breaks within a message are shown as "⏎".
 
 ---
 MESSAGES:
 {messages}
 ---
 
+Summarize this part of the conversation in bullet points. It will be combined with summaries of the
+other parts, so keep who said what, topics, decisions, questions and action items.
+
 Provide your bullet-point summary:"""
 
+# Prompt for combining the part summaries into the final summary
+# (use {summaries} and {focus} placeholders)
+MERGE_PROMPT: str = """You are a helpful assistant that summarizes Discord chat conversations.
+The conversation was too long to read at once, so it was split into consecutive parts that were
+summarized separately. The part summaries below are in chronological order (oldest first);
+treat them as the messages to summarize.
+
+---
+PART SUMMARIES:
+{summaries}
+---
+
+Focus instructions:
+{focus}
+
+Provide your bullet-point summary:"""